@@ -1,28 +1,233 @@
-from fastapi import FastAPI, File, UploadFile
+from fastapi import BackgroundTasks, FastAPI, File, UploadFile
 from fastapi.responses import JSONResponse
+import asyncio
+from contextlib import asynccontextmanager
+import csv
+import functools
+import hashlib
+import json
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 import os
 import time
-import kagglehub
-import glob
-import shutil
-import pandas as pd
-import io
+import uuid
+import requests
+import zipfile
+import tempfile
 from sqlalchemy import create_engine, text
 
 
-app = FastAPI(title="Camada de Ingestão de Dados (FastAPI)")
+# Upload multipart em partes de 8 MB: a memória fica limitada ao tamanho das partes,
+# e não ao tamanho do arquivo enviado
+UPLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=10,
+    use_threads=True
+)
+
+# Arquivos do Kaggle: partes maiores e mais concorrência
+KAGGLE_TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=16 * 1024 * 1024,
+    max_concurrency=16
+)
+
+# API do Kaggle: datasets/view/<slug> (metadados, inclui a versão atual) e
+# datasets/download/<slug> (dataset compactado em ZIP)
+KAGGLE_API_URL = "https://www.kaggle.com/api/v1"
+
+# Tamanho máximo do CSV bruto mantido em memória; acima disso o buffer vai para disco
+CSV_SPOOL_MAX_SIZE = 64 * 1024 * 1024
+
+# Download do CSV bruto em partes de 8 MB baixadas em paralelo (ranged GETs)
+DOWNLOAD_TRANSFER_CONFIG = TransferConfig(
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True
+)
+
+# Prefixo dos dados brutos no S3; os arquivos ficam em raw_data/AAAA/MM/DD/
+RAW_DATA_PREFIX = "raw_data/"
+
+# Objeto "ponteiro" com a chave do arquivo bruto mais recente no S3
+# (evita listar todo o prefixo raw_data/ para descobrir o último arquivo)
+LATEST_POINTER_KEY = f"{RAW_DATA_PREFIX}_latest.txt"
+
+# Índice de conteúdo: raw_data_hashes/<sha256>.txt guarda a chave do arquivo com aquele conteúdo
+# (evita reenviar ao S3 um arquivo idêntico a um já armazenado)
+RAW_HASH_INDEX_PREFIX = "raw_data_hashes/"
+
+# Última versão ingerida de cada dataset do Kaggle: raw_data_kaggle/<slug>.json guarda
+# {"version": ..., "s3_key": ...}, para não baixar de novo um dataset que não mudou
+KAGGLE_VERSION_PREFIX = "raw_data_kaggle/"
+
+# Estado das tarefas executadas em segundo plano (/ingest_kaggle/ e /load_raw_to_db/), por task_id.
+# Fica em memória: vale para um único worker do Uvicorn (com vários workers, usar um Redis).
+# Guarda no máximo MAX_TASKS tarefas; as concluídas mais antigas são descartadas
+TASKS = {}
+MAX_TASKS = 1000
+
+# --- CONEXÃO COM POSTGRESQL (usando as variáveis do .env) ---
+POSTGRES_USER = os.environ.get("POSTGRES_USER")
+POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
+POSTGRES_DB = os.environ.get("POSTGRES_DB")
+DB_HOST = os.environ.get("DB_HOST") # 'pg_db'
+# Driver explícito (psycopg2): no SQLAlchemy 2.1 "postgresql://" passou a usar o psycopg 3,
+# que não está instalado na imagem. A carga também depende dele: copy_expert só existe no psycopg2
+DATABASE_URL = f"postgresql+psycopg2://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:5432/{POSTGRES_DB}"
+
+# Engine único (pool de conexões reaproveitado entre as requisições)
+ENGINE = create_engine(
+    DATABASE_URL,
+    pool_size=10,
+    pool_pre_ping=True
+)
+
+# Tabela de dados brutos, com esquema explícito (colunas do dataset heart-statlog-cleveland-hungary).
+# O COPY usa a lista de colunas do cabeçalho do CSV, então a ordem das colunas no arquivo não importa.
+# A tabela é UNLOGGED (não escreve WAL): é só uma cópia do S3, então se o PostgreSQL cair
+# ela é esvaziada e basta chamar /load_raw_to_db/ novamente para recarregá-la
+RAW_TABLE_NAME = "heart_disease_raw"
+RAW_TABLE_COLUMNS = [
+    ("age", "SMALLINT"),
+    ("sex", "SMALLINT"),
+    ("chest pain type", "SMALLINT"),
+    ("resting bp s", "SMALLINT"),
+    ("cholesterol", "SMALLINT"),
+    ("fasting blood sugar", "SMALLINT"),
+    ("resting ecg", "SMALLINT"),
+    ("max heart rate", "SMALLINT"),
+    ("exercise angina", "SMALLINT"),
+    ("oldpeak", "REAL"),
+    ("ST slope", "SMALLINT"),
+    ("target", "SMALLINT"),
+]
+RAW_TABLE_DDL = (
+    f"CREATE UNLOGGED TABLE IF NOT EXISTS {RAW_TABLE_NAME} ("
+    + ", ".join(f'"{name}" {sql_type}' for name, sql_type in RAW_TABLE_COLUMNS)
+    + ")"
+)
+
+def warm_up_db_pool():
+    """Abre uma conexão no pool na inicialização para a primeira requisição não pagar o handshake."""
+    try:
+        with ENGINE.connect() as conn:
+            conn.execute(text("SELECT 1"))
+    except Exception as e:
+        print(f"Aviso: não foi possível conectar ao PostgreSQL na inicialização: {e}")
+
+@asynccontextmanager
+async def lifespan(app):
+    """Inicialização da API: aquece o pool de conexões com o PostgreSQL."""
+    await asyncio.to_thread(warm_up_db_pool)
+    yield
+
+
+app = FastAPI(title="Camada de Ingestão de Dados (FastAPI)", lifespan=lifespan)
+
+# Máximo de conexões HTTP abertas pelo cliente S3 compartilhado. O padrão do botocore (10) é menor
+# que o max_concurrency de um único download, e várias requisições simultâneas usam o mesmo cliente
+S3_MAX_POOL_CONNECTIONS = 64
 
 # Configuração do Boto3 (para AWS S3)
+# O cliente é criado uma única vez e reaproveitado (clientes boto3 são thread-safe)
+@functools.lru_cache(maxsize=1)
 def get_s3_client():
     # As credenciais são lidas automaticamente do ambiente, injetadas pelo docker-compose
     return boto3.client(
         's3',
         aws_access_key_id=os.environ.get("AWS_ACCESS_KEY_ID"),
         aws_secret_access_key=os.environ.get("AWS_SECRET_ACCESS_KEY"),
-        region_name=os.environ.get("AWS_REGION")
+        region_name=os.environ.get("AWS_REGION"),
+        config=Config(max_pool_connections=S3_MAX_POOL_CONNECTIONS)
     )
 
+def build_raw_key(file_name_base, file_extension, timestamp_ns):
+    """Monta a chave do arquivo bruto no S3, particionada por data (raw_data/AAAA/MM/DD/...)."""
+    date_prefix = time.strftime("%Y/%m/%d", time.gmtime(timestamp_ns // 1_000_000_000))
+    return f"{RAW_DATA_PREFIX}{date_prefix}/{file_name_base}_{timestamp_ns}.{file_extension}"
+
+def sha256_of_fileobj(f):
+    """Calcula o SHA-256 de um arquivo lendo em blocos e volta o cursor para o início."""
+    digest = hashlib.sha256()
+    for block in iter(lambda: f.read(1024 * 1024), b""):
+        digest.update(block)
+    f.seek(0)
+    return digest.hexdigest()
+
+def s3_object_exists(s3_client, bucket_name, key):
+    """Verifica (com HEAD) se um objeto existe no S3."""
+    try:
+        s3_client.head_object(Bucket=bucket_name, Key=key)
+        return True
+    except ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+
+def store_raw_fileobj(s3_client, bucket_name, f, file_name_base, file_extension, transfer_config):
+    """Armazena um arquivo bruto no S3, sem reenviar conteúdo que já está lá.
+
+    Retorna (chave no S3, True se o conteúdo já existia). Em ambos os casos o ponteiro
+    do arquivo mais recente passa a apontar para a chave retornada.
+    """
+    content_hash = sha256_of_fileobj(f)
+    hash_index_key = f"{RAW_HASH_INDEX_PREFIX}{content_hash}.txt"
+    
+    try:
+        index_obj = s3_client.get_object(Bucket=bucket_name, Key=hash_index_key)
+        indexed_key = index_obj['Body'].read().decode()
+    except s3_client.exceptions.NoSuchKey:
+        indexed_key = None
+    
+    # O índice só vale se o arquivo ainda existe (ele pode ter sido apagado à mão ou por lifecycle)
+    if indexed_key and s3_object_exists(s3_client, bucket_name, indexed_key):
+        s3_key = indexed_key
+        is_duplicate = True
+    else:
+        # Conteúdo novo (ou o arquivo indexado sumiu): envia em streaming (upload multipart) e registra no índice
+        s3_key = build_raw_key(file_name_base, file_extension, time.time_ns())
+        s3_client.upload_fileobj(f, bucket_name, s3_key, Config=transfer_config)
+        s3_client.put_object(Bucket=bucket_name, Key=hash_index_key, Body=s3_key.encode())
+        is_duplicate = False
+    
+    # Atualiza o ponteiro para o arquivo mais recente
+    s3_client.put_object(Bucket=bucket_name, Key=LATEST_POINTER_KEY, Body=s3_key.encode())
+    
+    return s3_key, is_duplicate
+
+def find_latest_raw_key(s3_client, bucket_name):
+    """Procura o arquivo bruto mais recente listando o S3 (usado quando o ponteiro não existe).
+
+    Desce pelos prefixos de data (ano -> mês -> dia) escolhendo sempre o maior, e só então
+    lista os arquivos do dia mais recente, com paginação (list_objects_v2 devolve no máximo 1000 chaves).
+    """
+    paginator = s3_client.get_paginator('list_objects_v2')
+    prefix = RAW_DATA_PREFIX
+    
+    # Os prefixos têm zero à esquerda, então a ordem lexicográfica é a ordem cronológica
+    for _ in range(3):
+        sub_prefixes = [
+            common_prefix['Prefix']
+            for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix, Delimiter='/')
+            for common_prefix in page.get('CommonPrefixes', [])
+        ]
+        if not sub_prefixes:
+            break
+        prefix = max(sub_prefixes)
+    
+    latest_file = None
+    for page in paginator.paginate(Bucket=bucket_name, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            if obj['Key'] == LATEST_POINTER_KEY:
+                continue
+            if latest_file is None or obj['LastModified'] > latest_file['LastModified']:
+                latest_file = obj
+    
+    return latest_file['Key'] if latest_file else None
+
 @app.post("/upload_data/")
 async def upload_data(file: UploadFile = File(...)):
     """[OPCIONAL] Recebe um arquivo via POST e armazena-o no S3 (dados brutos)."""
@@ -30,25 +235,32 @@ async def upload_data(file: UploadFile = File(...)):
     s3_client = get_s3_client()
     bucket_name = os.environ.get("S3_BUCKET_NAME")
     
-    timestamp = int(time.time())
     file_extension = file.filename.split('.')[-1]
     file_name_base = file.filename.split('.')[0]
-    s3_key = f"raw_data/{file_name_base}_{timestamp}.{file_extension}"
     
     try:
-        file_content = await file.read()
-        
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=file_content
+        # Envia o arquivo em streaming (sem carregar tudo em memória) numa thread,
+        # para não bloquear o event loop; conteúdo repetido não é reenviado
+        s3_key, is_duplicate = await asyncio.to_thread(
+            store_raw_fileobj,
+            s3_client,
+            bucket_name,
+            file.file,
+            file_name_base,
+            file_extension,
+            UPLOAD_TRANSFER_CONFIG
         )
         
         s3_url = f"s3://{bucket_name}/{s3_key}"
         
+        if is_duplicate:
+            message = "Arquivo idêntico já estava no S3; upload ignorado."
+        else:
+            message = "Dados brutos carregados para o S3 via upload manual."
+        
         return JSONResponse(content={
             "status": "sucesso",
-            "message": "Dados brutos carregados para o S3 via upload manual.",
+            "message": message,
             "s3_path": s3_url
         })
     except Exception as e:
@@ -57,117 +269,267 @@ async def upload_data(file: UploadFile = File(...)):
             "message": f"Falha no upload para o S3: {str(e)}"
         })
 
-# NOVO ENDPOINT DE INGESTÃO AUTOMÁTICA
-@app.post("/ingest_kaggle/")
-async def ingest_kaggle_data():
+def get_kaggle_auth():
+    """Credenciais opcionais da API do Kaggle (datasets públicos também podem ser baixados sem elas)."""
+    if os.environ.get("KAGGLE_USERNAME") and os.environ.get("KAGGLE_KEY"):
+        return (os.environ.get("KAGGLE_USERNAME"), os.environ.get("KAGGLE_KEY"))
+    return None
+
+def get_kaggle_dataset_version(dataset_slug):
+    """Retorna a versão atual do dataset no Kaggle, ou None se não for possível consultá-la."""
+    try:
+        response = requests.get(f"{KAGGLE_API_URL}/datasets/view/{dataset_slug}", auth=get_kaggle_auth(), timeout=30)
+        response.raise_for_status()
+        return response.json()["currentVersionNumber"]
+    except (requests.RequestException, ValueError, KeyError) as e:
+        print(f"Aviso: não foi possível consultar a versão do dataset {dataset_slug}: {e}")
+        return None
+
+def stream_kaggle_csv_to_s3(s3_client, bucket_name, dataset_slug):
+    """Baixa o ZIP do dataset pela API do Kaggle e envia o CSV principal ao S3.
+
+    Retorna (chave no S3, True se o conteúdo já existia), como em store_raw_fileobj. Se a versão
+    do dataset no Kaggle é a mesma da última ingestão, nem baixa o ZIP.
+
+    O ZIP fica num buffer em memória (só vai para disco se passar de CSV_SPOOL_MAX_SIZE), pois o
+    zipfile precisa de um arquivo "seekable"; o CSV é lido do ZIP e enviado em streaming.
+    """
+    # 0. Comparar a versão atual do dataset com a da última ingestão
+    version = get_kaggle_dataset_version(dataset_slug)
+    version_key = f"{KAGGLE_VERSION_PREFIX}{dataset_slug}.json"
+    
+    if version is not None:
+        try:
+            last_ingest = json.loads(s3_client.get_object(Bucket=bucket_name, Key=version_key)['Body'].read())
+        except s3_client.exceptions.NoSuchKey:
+            last_ingest = None
+        
+        # Dataset inalterado (e o arquivo registrado ainda existe no S3): só garante que o ponteiro aponta para ele
+        if (
+            last_ingest
+            and last_ingest["version"] == version
+            and s3_object_exists(s3_client, bucket_name, last_ingest["s3_key"])
+        ):
+            s3_client.put_object(Bucket=bucket_name, Key=LATEST_POINTER_KEY, Body=last_ingest["s3_key"].encode())
+            return last_ingest["s3_key"], True
+    
+    download_url = f"{KAGGLE_API_URL}/datasets/download/{dataset_slug}"
+    params = {"datasetVersionNumber": version} if version is not None else None
+    
+    with tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE) as zip_buffer:
+        # 1. Baixar o ZIP do Kaggle em streaming
+        with requests.get(download_url, params=params, auth=get_kaggle_auth(), stream=True, timeout=60) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(chunk_size=1024 * 1024):
+                zip_buffer.write(chunk)
+        zip_buffer.seek(0)
+        
+        with zipfile.ZipFile(zip_buffer) as zf:
+            # 2. Encontrar o arquivo CSV principal dentro do ZIP
+            # (o menor nome em ordem alfabética, para a escolha não depender da ordem no ZIP)
+            csv_member = min((name for name in zf.namelist() if name.endswith('.csv')), default=None)
+            if not csv_member:
+                raise Exception("Nenhum arquivo CSV principal encontrado no download do Kaggle.")
+            
+            file_name = os.path.basename(csv_member)
+            
+            # 3. Enviar o CSV para o S3 em streaming (se o conteúdo ainda não estiver lá)
+            with zf.open(csv_member) as f:
+                s3_key, is_duplicate = store_raw_fileobj(
+                    s3_client, bucket_name, f, file_name.split('.')[0], "csv", KAGGLE_TRANSFER_CONFIG
+                )
+    
+    # 4. Registrar a versão ingerida, para a próxima ingestão poder pular o download
+    if version is not None:
+        s3_client.put_object(
+            Bucket=bucket_name, Key=version_key, Body=json.dumps({"version": version, "s3_key": s3_key}).encode()
+        )
+    
+    return s3_key, is_duplicate
+
+def create_task():
+    """Registra uma nova tarefa em segundo plano e retorna seu id."""
+    task_id = uuid.uuid4().hex
+    TASKS[task_id] = {"status": "pendente"}
+    
+    # Descarta as tarefas concluídas mais antigas (o dict mantém a ordem de criação)
+    finished_task_ids = [tid for tid, task in TASKS.items() if task["status"] in ("sucesso", "erro")]
+    for old_task_id in finished_task_ids[:max(0, len(TASKS) - MAX_TASKS)]:
+        del TASKS[old_task_id]
+    
+    return task_id
+
+async def run_ingest_kaggle(task_id):
     """Baixa o dataset específico de doença cardíaca do Kaggle e o armazena no S3."""
     
+    TASKS[task_id] = {"status": "executando"}
+    
     # SLUG do dataset solicitado
     dataset_slug = "sid321axn/heart-statlog-cleveland-hungary-final"
     
     s3_client = get_s3_client()
     bucket_name = os.environ.get("S3_BUCKET_NAME")
     
-    # Variáveis para limpeza
-    path_to_dir = None
-    
     try:
-        # 1. Baixar o dataset do Kaggle (cria uma pasta temporária)
+        # 1. Baixar o dataset do Kaggle e enviar o CSV principal para o S3, sem passar pelo disco
         print(f"Baixando dataset: {dataset_slug}...")
-        path_to_dir = kagglehub.dataset_download(dataset_slug)
-        
-        # 2. Encontrar o arquivo CSV principal (o dataset é uma pasta)
-        csv_files = glob.glob(f"{path_to_dir}/*.csv")
-        if not csv_files:
-            raise Exception("Nenhum arquivo CSV principal encontrado no download do Kaggle.")
-            
-        local_file_path = csv_files[0]
-        file_name = os.path.basename(local_file_path)
-        
-        # 3. Preparar caminho no S3
-        timestamp = int(time.time())
-        s3_key = f"raw_data/{file_name.split('.')[0]}_{timestamp}.csv"
-        
-        # 4. Ler o arquivo local e fazer upload para o S3
-        with open(local_file_path, 'rb') as f:
-            file_content = f.read()
-        
-        s3_client.put_object(
-            Bucket=bucket_name,
-            Key=s3_key,
-            Body=file_content
+        s3_key, is_duplicate = await asyncio.to_thread(
+            stream_kaggle_csv_to_s3, s3_client, bucket_name, dataset_slug
         )
         
         s3_url = f"s3://{bucket_name}/{s3_key}"
         
-        return JSONResponse(content={
+        if is_duplicate:
+            message = f"Dataset '{dataset_slug}' sem alterações desde a última ingestão; nada foi enviado ao S3."
+        else:
+            message = f"Dataset '{dataset_slug}' baixado do Kaggle e armazenado no S3."
+        
+        TASKS[task_id] = {
             "status": "sucesso",
-            "message": f"Dataset '{dataset_slug}' baixado do Kaggle e armazenado no S3.",
+            "message": message,
             "s3_path": s3_url
-        })
+        }
     except Exception as e:
-        return JSONResponse(status_code=500, content={
+        TASKS[task_id] = {
             "status": "erro", 
             "message": f"Falha na ingestão do Kaggle: {str(e)}"
-        })
-    finally:
-        # 5. Limpar arquivos temporários baixados pelo kagglehub
-        if path_to_dir and os.path.exists(path_to_dir):
-            shutil.rmtree(path_to_dir, ignore_errors=True)
+        }
 
+# NOVO ENDPOINT DE INGESTÃO AUTOMÁTICA
+@app.post("/ingest_kaggle/")
+async def ingest_kaggle_data(background_tasks: BackgroundTasks):
+    """Agenda a ingestão do Kaggle em segundo plano; o resultado é consultado em /tasks/{task_id}."""
+    task_id = create_task()
+    background_tasks.add_task(run_ingest_kaggle, task_id)
+    return JSONResponse(status_code=202, content={"status": "pendente", "task_id": task_id})
 
-  # NOVO ENDPOINT: PEGA DO S3 E MANDA PARA O POSTGRESQL
 
-@app.post("/load_raw_to_db/")
-async def load_raw_to_db():
+def read_csv_header_columns(csv_buffer):
+    """Lê o cabeçalho do CSV e retorna a lista de colunas já entre aspas para o SQL; volta o cursor ao início."""
+    header_line = csv_buffer.readline().decode('utf-8-sig')
+    csv_buffer.seek(0)
+    columns = next(csv.reader([header_line]), [])
+    if not columns:
+        raise Exception("CSV sem cabeçalho.")
+    return ", ".join('"' + column.replace('"', '""') + '"' for column in columns)
+
+def drop_raw_table_if_outdated(cur):
+    """Remove a tabela de dados brutos se o esquema dela for diferente de RAW_TABLE_COLUMNS.
+
+    Tabelas criadas pelo antigo to_sql têm tipos inferidos pelo pandas (BIGINT, DOUBLE PRECISION);
+    como a tabela é só uma cópia do S3, basta recriá-la com o esquema explícito.
+    """
+    cur.execute(
+        "SELECT column_name, data_type FROM information_schema.columns "
+        "WHERE table_schema = current_schema() AND table_name = %s ORDER BY ordinal_position",
+        (RAW_TABLE_NAME,)
+    )
+    existing_columns = cur.fetchall()
+    expected_columns = [(name, sql_type.lower()) for name, sql_type in RAW_TABLE_COLUMNS]
+    
+    if existing_columns and [tuple(column) for column in existing_columns] != expected_columns:
+        cur.execute(f"DROP TABLE {RAW_TABLE_NAME}")
+
+def copy_csv_to_db(csv_buffer):
+    """Cria a tabela (se necessário), esvazia-a e carrega o CSV via COPY. Retorna o número de linhas carregadas."""
+    
+    # CARREGAR NO POSTGRESQL VIA COPY (bem mais rápido que os INSERTs do to_sql);
+    # TRUNCATE + COPY em vez de recriar a tabela a cada carga
+    conn = ENGINE.raw_connection()
+    try:
+        cur = conn.cursor()
+        # A fonte de verdade é o S3: não precisa esperar o flush do WAL a cada commit desta carga
+        # (SET LOCAL vale só para esta transação)
+        cur.execute("SET LOCAL synchronous_commit = OFF")
+        cur.execute("SET LOCAL client_min_messages = WARNING")
+        # A tabela é criada na própria carga (e não só na inicialização), pois o PostgreSQL pode
+        # ainda não estar pronto quando a API sobe, ou o banco pode ter sido recriado depois
+        drop_raw_table_if_outdated(cur)
+        cur.execute(RAW_TABLE_DDL)
+        # Tabelas criadas antes (com log) passam a ser UNLOGGED (não faz nada se já forem)
+        cur.execute(f"ALTER TABLE {RAW_TABLE_NAME} SET UNLOGGED")
+        cur.execute(f"TRUNCATE TABLE {RAW_TABLE_NAME}")
+        # Colunas listadas explicitamente a partir do cabeçalho: sem isso o COPY associa por posição,
+        # e um CSV com as colunas em outra ordem seria carregado nas colunas erradas
+        columns_sql = read_csv_header_columns(csv_buffer)
+        # copy_expert é da API do psycopg2 (driver fixado em DATABASE_URL)
+        cur.copy_expert(
+            f"COPY {RAW_TABLE_NAME} ({columns_sql}) FROM STDIN WITH (FORMAT CSV, HEADER TRUE)",
+            csv_buffer
+        )
+        rows_loaded = cur.rowcount
+        conn.commit()
+    finally:
+        conn.close()
+    
+    return rows_loaded
+
+
+async def run_load_raw_to_db(task_id):
     """Lê o arquivo CSV mais recente do S3 (dados brutos) e carrega-o no PostgreSQL."""
     
+    TASKS[task_id] = {"status": "executando"}
+    
     s3_client = get_s3_client()
     bucket_name = os.environ.get("S3_BUCKET_NAME")
-    s3_prefix = "raw_data/"
-    RAW_TABLE_NAME = "heart_disease_raw"
-    
-    # --- 1. CONFIGURAR CONEXÃO COM POSTGRESQL (usando as variáveis do .env) ---
-    POSTGRES_USER = os.environ.get("POSTGRES_USER")
-    POSTGRES_PASSWORD = os.environ.get("POSTGRES_PASSWORD")
-    POSTGRES_DB = os.environ.get("POSTGRES_DB")
-    DB_HOST = os.environ.get("DB_HOST") # 'pg_db'
-    DATABASE_URL = f"postgresql://{POSTGRES_USER}:{POSTGRES_PASSWORD}@{DB_HOST}:5432/{POSTGRES_DB}"
     
     try:
-        # 2. ENCONTRAR O ARQUIVO MAIS RECENTE NO S3
-        response = s3_client.list_objects_v2(Bucket=bucket_name, Prefix=s3_prefix)
-        
-        if 'Contents' not in response:
-            return JSONResponse(status_code=404, content={"status": "erro", "message": "Nenhum arquivo encontrado no S3."})
-
-        latest_file = max(response['Contents'], key=lambda x: x['LastModified'])
-        s3_key_full = latest_file['Key']
+        # 1. ENCONTRAR O ARQUIVO MAIS RECENTE NO S3 (lido do objeto ponteiro)
+        try:
+            pointer = await asyncio.to_thread(s3_client.get_object, Bucket=bucket_name, Key=LATEST_POINTER_KEY)
+            s3_key_full = (await asyncio.to_thread(pointer['Body'].read)).decode()
+        except s3_client.exceptions.NoSuchKey:
+            # Sem ponteiro (ex.: arquivos enviados antes dele existir): procura listando o S3
+            s3_key_full = await asyncio.to_thread(find_latest_raw_key, s3_client, bucket_name)
         
-        # 3. BAIXAR O ARQUIVO E LER DIRETAMENTE PARA O PANDAS
-        obj = s3_client.get_object(Bucket=bucket_name, Key=s3_key_full)
-        # Nota: Usando 'df_raw' como variável local para clareza
-        df_raw = pd.read_csv(io.BytesIO(obj['Body'].read())) 
+        if not s3_key_full:
+            TASKS[task_id] = {"status": "erro", "message": "Nenhum arquivo encontrado no S3."}
+            return
         
-        # 4. CONECTAR E SALVAR NO POSTGRESQL
-        engine = create_engine(DATABASE_URL)
-        df_raw.to_sql(
-            RAW_TABLE_NAME, 
-            engine, 
-            if_exists='replace', # Recria a tabela toda vez
-            index=False 
-        )
+        # 2. BAIXAR O ARQUIVO DO S3 (download multipart em paralelo)
+        # O buffer fica em memória só até CSV_SPOOL_MAX_SIZE; arquivos maiores vão para disco,
+        # mantendo o uso de memória limitado independentemente do tamanho do CSV
+        csv_buffer = tempfile.SpooledTemporaryFile(max_size=CSV_SPOOL_MAX_SIZE)
+        try:
+            await asyncio.to_thread(
+                s3_client.download_fileobj, bucket_name, s3_key_full, csv_buffer, Config=DOWNLOAD_TRANSFER_CONFIG
+            )
+            csv_buffer.seek(0)
+            
+            # 3. CARREGAR NO POSTGRESQL (numa thread, para não bloquear o event loop)
+            rows_loaded = await asyncio.to_thread(copy_csv_to_db, csv_buffer)
+        finally:
+            csv_buffer.close()
         
-        return JSONResponse(content={
+        TASKS[task_id] = {
             "status": "sucesso", 
             "message": f"Dados brutos do S3 carregados para PostgreSQL na tabela: {RAW_TABLE_NAME}",
-            "rows_loaded": len(df_raw)
-        })
+            "rows_loaded": rows_loaded
+        }
         
     except Exception as e:
-        return JSONResponse(status_code=500, content={
+        TASKS[task_id] = {
             "status": "erro", 
             "message": f"Falha na estruturação (S3 -> DB): {str(e)}"
-        })
+        }
+
+
+  # NOVO ENDPOINT: PEGA DO S3 E MANDA PARA O POSTGRESQL
+
+@app.post("/load_raw_to_db/")
+async def load_raw_to_db(background_tasks: BackgroundTasks):
+    """Agenda a carga S3 -> PostgreSQL em segundo plano; o resultado é consultado em /tasks/{task_id}."""
+    task_id = create_task()
+    background_tasks.add_task(run_load_raw_to_db, task_id)
+    return JSONResponse(status_code=202, content={"status": "pendente", "task_id": task_id})
+
+
+@app.get("/tasks/{task_id}")
+async def get_task_status(task_id: str):
+    """Retorna o estado de uma tarefa em segundo plano (pendente, executando, sucesso ou erro)."""
+    task = TASKS.get(task_id)
+    if task is None:
+        return JSONResponse(status_code=404, content={"status": "erro", "message": "Tarefa não encontrada."})
+    return JSONResponse(content={"task_id": task_id, **task})
 
 